@@ -7,6 +7,12 @@ import math
 import pygame
 import pygame.gfxdraw  # 引入進階繪圖庫以獲得更好畫質
 import copy
+import collections
+import contextlib
+import base64
+import zlib
+from framing import LineFramer
+from tiles import BASE_TILE, stroke_margin, stroke_segments, segment_tiles
 
 # =====================Q=====================
 #               系統參數設定
@@ -24,31 +30,141 @@ BRUSH_MIN, BRUSH_MAX = 2, 60
 ERASER_SIZES = [16, 32, 64]
 ERASER_SNAP_COUNT = 3
 
+# 網路量測 / 自適應批次
+PING_INTERVAL = 1.0        # 每秒量一次 RTT
+RTT_ALPHA = 0.125          # EWMA 權重 (同 TCP SRTT)
+RATE_WINDOW = 1.0          # 流量統計視窗 (秒)
+LAN_RTT = 0.005            # 低於此 RTT 視為區網，點立即送出
+SEND_BLOCK_SLOW = 0.002    # sendall 阻塞超過此值 → 送出緩衝已滿，用來量測連線頻寬
+UTIL_HIGH = 0.5            # 送出量超過估計頻寬的這個比例就開始拉長批次 / 游標間隔
+CURSOR_MIN_INTERVAL = 1 / 120
+CURSOR_MAX_INTERVAL = 0.2
+BATCH_MAX_WINDOW = 0.1
+BATCH_MAX_POINTS = 512     # 一則 stroke_points 最多幾點 (每點約 20 bytes，需低於伺服器的 MAX_MSG_BYTES 16KB)
+
+# 無限畫布 (中鍵/右鍵拖曳平移，滾輪縮放，Home 回原點)
+ZOOM_MIN, ZOOM_MAX = 0.05, 8.0
+ZOOM_STEP = 1.1            # 滾輪每格縮放倍率
+LOD_ZOOM = 0.5             # 縮放低於此值時簡化筆畫
+LOD_MIN_PX = 3             # 簡化時相鄰點的最小螢幕距離
+BASE_CHUNK_BYTES = 512 * 1024   # 上傳底圖時每則訊息的 tile 資料上限 (伺服器單行上限 4MB)
+RECENT_DELETED = 256       # 保留最近刪除的筆畫，刪除與伺服器 bake 交錯時仍能畫進底圖
+
+# 分層合成：最近的筆畫每幾筆快取成一層，undo 只重畫受影響的那層
+LAYERED = True
+LAYER_SEGMENT = 8          # 每層幾筆 (undo 時最多重畫這麼多筆)
+LAYER_WINDOW = 64          # 最近幾筆分層快取 (約兩位使用者的 undo 範圍，伺服器 UNDO_DEPTH 預設 32)
+LAYER_REBUILD_DELAY = 0.2  # 視窗停止移動多久後才重新分層
+
+# 效能分析 (F3 開關 overlay，F4 匯出 Chrome trace)
+PROFILE_HISTORY = 600      # 保留最近幾幀
+PROFILE_AVG_FRAMES = 120   # overlay 平均的幀數
+
 incoming = queue.Queue()
 
 # ============112==============================
-#               網路通訊模組 (維持不變)
+#               網路通訊模組
 # ==========================================
+class NetStats:
+    """
+    RTT 與流量估計
+    recv_loop 執行緒寫入 pong / 接收量，主執行緒寫入送出量並讀取
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rtt = None          # 秒 (EWMA)
+        self.peer_rtt = None     # 對方量到的 RTT
+        self.capacity = None     # 估計的上傳頻寬 bytes/s (sendall 阻塞時量得)
+        self.tx_rate = 0.0       # bytes/s
+        self.rx_rate = 0.0
+        self._win_start = time.perf_counter()
+        self._win_tx = 0
+        self._win_rx = 0
+
+    def on_sent(self, n, dt):
+        with self.lock:
+            self._win_tx += n
+            # 阻塞期間核心緩衝以連線速度排空，n / dt 近似頻寬
+            if dt > SEND_BLOCK_SLOW:
+                sample = n / dt
+                if self.capacity is None: self.capacity = sample
+                else: self.capacity += (sample - self.capacity) * RTT_ALPHA
+            self._roll()
+
+    def on_recv(self, n):
+        with self.lock:
+            self._win_rx += n
+            self._roll()
+
+    def on_pong(self, t_sent):
+        sample = time.perf_counter() - t_sent
+        if sample < 0: return
+        with self.lock:
+            if self.rtt is None: self.rtt = sample
+            else: self.rtt += (sample - self.rtt) * RTT_ALPHA
+
+    def _roll(self):
+        now = time.perf_counter()
+        span = now - self._win_start
+        if span < RATE_WINDOW: return
+        self.tx_rate = self._win_tx / span
+        self.rx_rate = self._win_rx / span
+        # 實際送出量證明頻寬至少這麼大；不再阻塞時估計值慢慢放寬
+        if self.capacity is not None:
+            self.capacity = max(self.capacity * 1.25, self.tx_rate)
+        self._win_start = now
+        self._win_tx = 0
+        self._win_rx = 0
+
+    def utilization(self):
+        """送出量 / 估計頻寬 (0 ~ 1)；從沒阻塞過表示頻寬不是瓶頸"""
+        if not self.capacity: return 0.0
+        return min(1.0, self.tx_rate / self.capacity)
+
+    def _pressure(self):
+        """超過 UTIL_HIGH 之後線性升到 1"""
+        return max(0.0, (self.utilization() - UTIL_HIGH) / (1 - UTIL_HIGH))
+
+    def cursor_interval(self):
+        """游標更新間隔：約半個 RTT，區網時跟著畫面更新率；頻寬吃緊時拉長"""
+        if self.rtt is None: return 0.05
+        iv = self.rtt / 2 + CURSOR_MAX_INTERVAL * self._pressure()
+        return max(CURSOR_MIN_INTERVAL, min(CURSOR_MAX_INTERVAL, iv))
+
+    def batch_window(self):
+        """stroke_point 批次視窗：區網為 0 (逐點送)，慢速或頻寬吃緊時累積後一次送"""
+        if self.rtt is None: return 0.0
+        win = 0.0 if self.rtt < LAN_RTT else self.rtt / 4
+        win = max(win, BATCH_MAX_WINDOW * self._pressure())
+        return min(BATCH_MAX_WINDOW, win)
+
+net = NetStats()
+
 def send_json(sock: socket.socket, obj: dict):
     try:
         payload = (json.dumps(obj, separators=(",", ":")) + "\n").encode("utf-8")
+        t0 = time.perf_counter()
         sock.sendall(payload)
+        net.on_sent(len(payload), time.perf_counter() - t0)
     except Exception as e:
         print(f"Send Error: {e}")
 
 def recv_loop(sock: socket.socket):
-    buf = b""
+    framer = LineFramer()
     while True:
         try:
-            data = sock.recv(4096)
+            data = sock.recv(65536)
             if not data: break
-            buf += data
-            while b"\n" in buf:
-                raw, buf = buf.split(b"\n", 1)
-                line = raw.decode("utf-8", errors="ignore").strip()
-                if not line: continue
-                try: incoming.put(json.loads(line))
-                except: pass
+            net.on_recv(len(data))
+            for line in framer.feed(data):
+                if line.isspace(): continue
+                try: msg = json.loads(line)
+                except: continue
+                # pong 直接在收包執行緒處理，避免主迴圈排隊延遲灌進 RTT
+                if msg.get("type") == "pong":
+                    if isinstance(msg.get("t"), (int, float)): net.on_pong(msg["t"])
+                    continue
+                incoming.put(msg)
         except: break
 
 # ==========================================
@@ -79,19 +195,455 @@ def draw_square_stamp(surface, center, size, color):
     r = pygame.Rect(x - size // 2, y - size // 2, size, size)
     pygame.draw.rect(surface, color, r)
 
-def redraw_all(canvas: pygame.Surface, all_strokes: list):
+def stroke_bbox(st):
+    """筆畫外框 [x0, y0, x1, y1] (世界座標)，第一次用到時計算並快取在 st["bbox"]"""
+    bb = st.get("bbox")
+    if bb is None:
+        pts = st["points"]
+        if not pts: return [0, 0, 0, 0]
+        m = stroke_margin(st)
+        xs = [p[0] for p in pts]
+        ys = [p[1] for p in pts]
+        bb = st["bbox"] = [min(xs) - m, min(ys) - m, max(xs) + m, max(ys) + m]
+    return bb
+
+def add_point(st, p):
+    st["points"].append(p)
+    bb = st.get("bbox")
+    if bb is not None:
+        m = stroke_margin(st)
+        bb[0] = min(bb[0], p[0] - m)
+        bb[1] = min(bb[1], p[1] - m)
+        bb[2] = max(bb[2], p[0] + m)
+        bb[3] = max(bb[3], p[1] + m)
+
+def decimate(pts, min_px):
+    """LOD：丟掉離上一個保留點太近的點 (保留最後一點)"""
+    out = [pts[0]]
+    lx, ly = pts[0]
+    for x, y in pts[1:]:
+        if abs(x - lx) + abs(y - ly) >= min_px:
+            out.append((x, y))
+            lx, ly = x, y
+    if out[-1] != pts[-1]: out.append(pts[-1])
+    return out
+
+def draw_stroke(surface, st, ox=0, oy=0, zoom=1.0):
+    """把筆畫畫到 surface；(ox, oy) 為 surface 左上角的世界座標"""
+    pts = st["points"]
+    color = st["color"]
+    if len(pts) < 1: return
+    if ox or oy or zoom != 1.0:
+        pts = [(int(round((x - ox) * zoom)), int(round((y - oy) * zoom))) for x, y in pts]
+        if zoom < LOD_ZOOM: pts = decimate(pts, LOD_MIN_PX)
+    if st["shape"] == "line":
+        w = max(1, int(st["w"] * zoom))
+        if len(pts) == 1: pygame.draw.circle(surface, color, pts[0], w // 2)
+        else:
+            for i in range(1, len(pts)):
+                draw_line_round_cap(surface, color, pts[i-1], pts[i], w)
+    elif st["shape"] == "square":
+        size = max(1, int(st["size"] * zoom))
+        for p in pts: draw_square_stamp(surface, p, size, color)
+
+class Viewport:
+    """世界座標 ↔ 畫布座標；(x, y) 是畫布左上角對應的世界座標"""
+    def __init__(self, w, h):
+        self.w, self.h = w, h
+        self.reset()
+
+    def reset(self):
+        self.x, self.y, self.zoom = 0.0, 0.0, 1.0
+
+    def to_screen(self, p):
+        return (int(round((p[0] - self.x) * self.zoom)), int(round((p[1] - self.y) * self.zoom)))
+
+    def to_world(self, p):
+        return (int(math.floor(self.x + p[0] / self.zoom)), int(math.floor(self.y + p[1] / self.zoom)))
+
+    def world_rect(self):
+        return (self.x, self.y, self.x + self.w / self.zoom, self.y + self.h / self.zoom)
+
+    def sees(self, bb):
+        x0, y0, x1, y1 = self.world_rect()
+        return bb[2] >= x0 and bb[0] <= x1 and bb[3] >= y0 and bb[1] <= y1
+
+    def pan(self, dx, dy):
+        self.x -= dx / self.zoom
+        self.y -= dy / self.zoom
+
+    def zoom_at(self, sp, factor):
+        """以畫布上的 sp 為中心縮放 (sp 下的世界座標不動)"""
+        wx = self.x + sp[0] / self.zoom
+        wy = self.y + sp[1] / self.zoom
+        self.zoom = max(ZOOM_MIN, min(ZOOM_MAX, self.zoom * factor))
+        self.x = wx - sp[0] / self.zoom
+        self.y = wy - sp[1] / self.zoom
+
+class TileLayer:
+    """
+    無限畫布的點陣底圖 (已壓平的歷史)
+    以 BASE_TILE 切塊、用到才建立；縮小檢視時各 tile 的縮圖另外快取
+    """
+    def __init__(self):
+        self.tiles = {}    # (tx, ty) -> Surface
+        self._scaled = {}  # (tx, ty) -> (size, Surface)
+
+    def clear(self):
+        self.tiles.clear()
+        self._scaled.clear()
+
+    def copy(self):
+        layer = TileLayer()
+        layer.tiles = {k: t.copy() for k, t in self.tiles.items()}
+        return layer
+
+    def draw_stroke(self, st):
+        """
+        只畫進每一段 / 每個印章實際經過的 tile，回傳碰到的 tile key
+        (長斜線的外框可能涵蓋上千個 tile，大部分根本沒畫到)
+        背景色 (像素橡皮擦) 畫在還沒建立的 tile 上沒有作用，不建立
+        """
+        m = stroke_margin(st)
+        parts = {}   # (tx, ty) -> [(a, b)]，依筆畫順序
+        for a, b in stroke_segments(st):
+            for key in segment_tiles(a, b, m):
+                parts.setdefault(key, []).append((a, b))
+
+        color = tuple(st["color"])
+        keys = []
+        for (tx, ty), segs in parts.items():
+            tile = self.tiles.get((tx, ty))
+            if tile is None:
+                if color == CANVAS_BG: continue
+                tile = self.tiles[(tx, ty)] = pygame.Surface((BASE_TILE, BASE_TILE))
+                tile.fill(CANVAS_BG)
+            ox, oy = tx * BASE_TILE, ty * BASE_TILE
+            for (ax, ay), (bx, by) in segs:
+                if st["shape"] == "square":
+                    draw_square_stamp(tile, (ax - ox, ay - oy), st["size"], color)
+                elif (ax, ay) == (bx, by):
+                    pygame.draw.circle(tile, color, (ax - ox, ay - oy), st["w"] // 2)
+                else:
+                    draw_line_round_cap(tile, color, (ax - ox, ay - oy), (bx - ox, by - oy), st["w"])
+            self._scaled.pop((tx, ty), None)
+            keys.append((tx, ty))
+        return keys
+
+    def blit_to(self, canvas, view):
+        x0, y0, x1, y1 = view.world_rect()
+        for tx in range(int(x0 // BASE_TILE), int(x1 // BASE_TILE) + 1):
+            for ty in range(int(y0 // BASE_TILE), int(y1 // BASE_TILE) + 1):
+                tile = self.tiles.get((tx, ty))
+                if tile is None: continue
+                wx, wy = tx * BASE_TILE, ty * BASE_TILE
+                if view.zoom == 1.0:
+                    canvas.blit(tile, view.to_screen((wx, wy)))
+                elif view.zoom > 1.0:
+                    # 放大：只縮放看得到的那一塊，不快取
+                    cx0 = max(0, int(math.floor(x0 - wx)))
+                    cy0 = max(0, int(math.floor(y0 - wy)))
+                    cx1 = min(BASE_TILE, int(math.ceil(x1 - wx)))
+                    cy1 = min(BASE_TILE, int(math.ceil(y1 - wy)))
+                    if cx1 <= cx0 or cy1 <= cy0: continue
+                    sx0, sy0 = view.to_screen((wx + cx0, wy + cy0))
+                    sx1, sy1 = view.to_screen((wx + cx1, wy + cy1))
+                    part = tile.subsurface((cx0, cy0, cx1 - cx0, cy1 - cy0))
+                    canvas.blit(pygame.transform.scale(part, (sx1 - sx0, sy1 - sy0)), (sx0, sy0))
+                else:
+                    # 縮小：快取縮圖 (LOD)
+                    sx0, sy0 = view.to_screen((wx, wy))
+                    sx1, sy1 = view.to_screen((wx + BASE_TILE, wy + BASE_TILE))
+                    size = (max(1, sx1 - sx0), max(1, sy1 - sy0))
+                    cached = self._scaled.get((tx, ty))
+                    if cached is None or cached[0] != size:
+                        cached = self._scaled[(tx, ty)] = (size, pygame.transform.smoothscale(tile, size))
+                    canvas.blit(cached[1], (sx0, sy0))
+
+    def encode_chunks(self, keys=None, budget=BASE_CHUNK_BYTES):
+        """
+        keys=None 表示全部 tile
+        依編碼後大小切成多則 {"tile", "tiles"}，每則不超過 budget (至少一個 tile)；
+        沒有 tile 時仍產生一則空的
+        """
+        keys = list(self.tiles.keys() if keys is None else keys)
+        chunk, size = {}, 0
+        for tx, ty in keys:
+            data = encode_surface(self.tiles[(tx, ty)])
+            if chunk and size + len(data["data"]) > budget:
+                yield {"tile": BASE_TILE, "tiles": chunk}
+                chunk, size = {}, 0
+            chunk[f"{tx},{ty}"] = data
+            size += len(data["data"])
+        yield {"tile": BASE_TILE, "tiles": chunk}
+
+    def merge(self, d):
+        for k, data in d.get("tiles", {}).items():
+            tx, ty = map(int, k.split(","))
+            self.tiles[(tx, ty)] = decode_surface(data)
+            self._scaled.pop((tx, ty), None)
+
+    def load(self, d):
+        self.clear()
+        self.merge(d)
+
+def redraw_all(canvas: pygame.Surface, all_strokes: list, base: TileLayer, view: Viewport):
+    """只重畫底圖與視窗內的筆畫 (viewport culling)"""
     canvas.fill(CANVAS_BG)
+    base.blit_to(canvas, view)
     for st in all_strokes:
-        pts = st["points"]
-        color = st["color"]
-        if len(pts) < 1: continue
-        if st["shape"] == "line":
-            if len(pts) == 1: pygame.draw.circle(canvas, color, pts[0], st["w"] // 2)
-            else:
-                for i in range(1, len(pts)):
-                    draw_line_round_cap(canvas, color, pts[i-1], pts[i], st["w"])
-        elif st["shape"] == "square":
-            for p in pts: draw_square_stamp(canvas, p, st["size"], color)
+        if view.sees(stroke_bbox(st)):
+            draw_stroke(canvas, st, view.x, view.y, view.zoom)
+
+class LayerCompositor:
+    """
+    把最近 LAYER_WINDOW 筆畫 (不分使用者) 依 z-order 每 LAYER_SEGMENT 筆切成一層，
+    各自快取成透明 surface，合成時 floor (底圖 + 較舊的筆畫) 之上依序疊各層
+    像素橡皮擦畫的是不透明的 CANVAS_BG，疊上去一樣會蓋掉下層，結果和 redraw_all 相同
+    刪掉一筆只重畫它所在的那層 (最多 LAYER_SEGMENT 筆)；層數超過時最舊的一層直接疊進 floor
+    視窗移動時不維護各層：invalidate() 後由呼叫端用 redraw_all 畫，停下來再 rebuild()
+    兩人同時畫時，進行中的筆畫可能不是所在層的最後一筆：新的一段先直接畫上去，
+    該層標記為 stale，由 refresh() 每 LAYER_REBUILD_DELAY 最多重畫一次 (否則每一點都要重畫整層)
+    """
+    def __init__(self, size):
+        self.size = size
+        self.floor = {"strokes": [], "surf": pygame.Surface(size)}
+        self.layers = []     # [{"strokes", "surf"}]，由下往上
+        self.layer_of = {}   # stroke_id -> 所在的層 (可能是 floor)
+        self.base = None
+        self.view = None
+        self.valid = False   # 各層是否和目前的畫面一致
+        self.invalid_since = 0.0
+        self.dirty = False   # 需要重新合成到 canvas
+        self.stale_since = None  # 最早一層被標記 stale 的時間
+        self._pool = []      # 回收的透明 surface
+
+    def invalidate(self):
+        self.valid = False
+        self.invalid_since = time.monotonic()
+        self.dirty = False
+
+    def rebuild(self, all_strokes, base, view):
+        """全部重新分層重畫"""
+        self.base, self.view = base, view
+        for layer in self.layers: self._pool.append(layer["surf"])
+        split = max(0, len(all_strokes) - LAYER_WINDOW)
+        self.floor["strokes"] = list(all_strokes[:split])
+        self._render_floor()
+        self.layers = []
+        for i in range(split, len(all_strokes), LAYER_SEGMENT):
+            layer = {"strokes": list(all_strokes[i:i + LAYER_SEGMENT]), "surf": self._take()}
+            self._render_layer(layer)
+            self.layers.append(layer)
+        self.layer_of = {st["id"]: layer for layer in [self.floor] + self.layers for st in layer["strokes"]}
+        self.stale_since = None
+        self.valid = True
+        self.dirty = True
+
+    def append(self, st):
+        """新筆畫放到最上層 (滿了就開新的一層)"""
+        if not self.valid: return
+        top = self.layers[-1] if self.layers else None
+        if top is None or len(top["strokes"]) >= LAYER_SEGMENT:
+            top = {"strokes": [], "surf": self._take()}
+            top["surf"].fill((0, 0, 0, 0))
+            self.layers.append(top)
+            if len(self.layers) > LAYER_WINDOW // LAYER_SEGMENT:
+                oldest = self.layers.pop(0)
+                self.floor["surf"].blit(oldest["surf"], (0, 0))
+                self.floor["strokes"].extend(oldest["strokes"])
+                for s in oldest["strokes"]: self.layer_of[s["id"]] = self.floor
+                if oldest.get("stale"): self.floor["stale"] = True
+                self._pool.append(oldest["surf"])
+        top["strokes"].append(st)
+        self.layer_of[st["id"]] = top
+
+    def remove(self, sid):
+        """刪除一筆：只重畫它所在的層"""
+        layer = self.layer_of.pop(sid, None)
+        if layer is None: return
+        layer["strokes"] = [s for s in layer["strokes"] if s["id"] != sid]
+        self.dirty = True
+        if layer is self.floor:
+            self._render_floor()
+        elif layer["strokes"]:
+            self._render_layer(layer)
+        else:
+            self.layers.remove(layer)
+            self._pool.append(layer["surf"])
+
+    def target(self, sid):
+        """
+        畫進行中筆畫用：回傳 (所在層的 surface, 是否為最上層)
+        surface 為 None 表示筆畫不在任何層
+        """
+        layer = self.layer_of.get(sid)
+        if layer is None: return None, False
+        if layer["strokes"][-1]["id"] != sid:
+            # 不是該層最後一筆：新的一段會暫時蓋到同層較新的筆畫，之後由 refresh() 重畫修正
+            layer["stale"] = True
+            if self.stale_since is None: self.stale_since = time.monotonic()
+        top = self.layers[-1] if self.layers else self.floor
+        return layer["surf"], layer is top
+
+    def refresh(self, delay=LAYER_REBUILD_DELAY):
+        """重畫 stale 的層 (距第一次標記超過 delay 秒才做)"""
+        if self.stale_since is None or time.monotonic() - self.stale_since < delay: return
+        self.stale_since = None
+        if self.floor.get("stale"): self._render_floor()
+        for layer in self.layers:
+            if layer.get("stale"): self._render_layer(layer)
+        self.dirty = True
+
+    def composite(self, canvas):
+        canvas.blit(self.floor["surf"], (0, 0))
+        for layer in self.layers: canvas.blit(layer["surf"], (0, 0))
+        self.dirty = False
+
+    def _take(self):
+        if self._pool: return self._pool.pop()
+        return pygame.Surface(self.size, pygame.SRCALPHA)
+
+    def _render_floor(self):
+        self.floor["stale"] = False
+        redraw_all(self.floor["surf"], self.floor["strokes"], self.base, self.view)
+
+    def _render_layer(self, layer):
+        layer["stale"] = False
+        surf = layer["surf"]
+        surf.fill((0, 0, 0, 0))
+        view = self.view
+        for st in layer["strokes"]:
+            if view.sees(stroke_bbox(st)):
+                draw_stroke(surf, st, view.x, view.y, view.zoom)
+
+def encode_surface(surface):
+    """Surface → JSON 可傳的 dict (RGB + zlib + base64)"""
+    w, h = surface.get_size()
+    raw = pygame.image.tostring(surface, "RGB")
+    return {"w": w, "h": h, "data": base64.b64encode(zlib.compress(raw, 6)).decode("ascii")}
+
+def decode_surface(d):
+    raw = zlib.decompress(base64.b64decode(d["data"]))
+    return pygame.image.fromstring(raw, (d["w"], d["h"]), "RGB")
+
+# ==========================================
+#               效能分析
+# ==========================================
+_NO_SPAN = contextlib.nullcontext()
+
+class FrameProfiler:
+    """
+    主迴圈每幀各階段計時
+    lap(name): 記錄上一個 lap 到現在的區段 (主迴圈的依序階段)
+    span(name): with 區塊內的巢狀區段 (redraw、橡皮擦掃描…)
+    關閉時每個呼叫只做一次 None 判斷
+    """
+    def __init__(self):
+        self.enabled = False
+        self.frames = collections.deque(maxlen=PROFILE_HISTORY)
+        self._frame = None
+        self._last = 0.0
+        self._depth = 0
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if not self.enabled: self._frame = None
+
+    def begin_frame(self, queue_depth):
+        if not self.enabled: return
+        self._last = time.perf_counter()
+        self._frame = {"t": self._last, "spans": [], "queue": queue_depth, "applied": 0}
+
+    def lap(self, name):
+        f = self._frame
+        if f is None: return
+        now = time.perf_counter()
+        f["spans"].append((name, self._last, now, 0))
+        self._last = now
+
+    def span(self, name):
+        if self._frame is None: return _NO_SPAN
+        return _ProfileSpan(self, name)
+
+    def count_applied(self, n):
+        if self._frame is not None: self._frame["applied"] += n
+
+    def end_frame(self):
+        f = self._frame
+        if f is None: return
+        f["end"] = self._last
+        self.frames.append(f)
+        self._frame = None
+
+    def summary(self):
+        """最近幾幀各階段平均 / 最大 (ms)，依第一次出現順序"""
+        recent = list(self.frames)[-PROFILE_AVG_FRAMES:]
+        rows = {}
+        for f in recent:
+            per = {}
+            for name, t0, t1, depth in sorted(f["spans"], key=lambda sp: sp[1]):
+                per[(name, depth)] = per.get((name, depth), 0.0) + (t1 - t0)
+            for key, d in per.items():
+                tot, mx = rows.get(key, (0.0, 0.0))
+                rows[key] = (tot + d, max(mx, d))
+        n = max(1, len(recent))
+        return [(name, depth, tot / n * 1000, mx * 1000) for (name, depth), (tot, mx) in rows.items()]
+
+    def export_chrome_trace(self, path):
+        """匯出 chrome://tracing / Perfetto 可讀的 JSON"""
+        if not self.frames: return False
+        base = self.frames[0]["t"]
+        def us(t): return round((t - base) * 1e6, 1)
+        events = []
+        for i, f in enumerate(self.frames):
+            events.append({"name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": us(f["t"]), "dur": round((f["end"] - f["t"]) * 1e6, 1), "args": {"frame": i}})
+            for name, t0, t1, depth in f["spans"]:
+                events.append({"name": name, "ph": "X", "pid": 1, "tid": 1,
+                               "ts": us(t0), "dur": round((t1 - t0) * 1e6, 1)})
+            events.append({"name": "network", "ph": "C", "pid": 1, "ts": us(f["t"]),
+                           "args": {"queue_depth": f["queue"], "applied": f["applied"]}})
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+        return True
+
+class _ProfileSpan:
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.frame = prof._frame
+        self.name = name
+
+    def __enter__(self):
+        self.prof._depth += 1
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        t1 = time.perf_counter()
+        self.prof._depth -= 1
+        self.frame["spans"].append((self.name, self.t0, t1, self.prof._depth + 1))
+
+def draw_profiler_overlay(screen, prof, font):
+    """左上角顯示各階段耗時 (平均 / 最大) 與網路佇列"""
+    rows = prof.summary()
+    recent = list(prof.frames)[-PROFILE_AVG_FRAMES:]
+    n = max(1, len(recent))
+    frame_ms = sum(f["end"] - f["t"] for f in recent) / n * 1000
+    lines = [f"frame  {frame_ms:6.2f} ms  (F4: export trace)"]
+    for name, depth, avg, mx in rows:
+        lines.append(f"{'  ' * (depth + 1)}{name:<12}{avg:6.2f} / {mx:6.2f} ms")
+    if recent:
+        last = recent[-1]
+        lines.append(f"queue {last['queue']}   applied {sum(f['applied'] for f in recent) / n:.1f}/frame")
+
+    surfs = [font.render(line, True, (230, 230, 230)) for line in lines]
+    w = max(s.get_width() for s in surfs) + 16
+    h = sum(s.get_height() for s in surfs) + 12
+    draw_rounded_rect(screen, (8, HUD_H + 8, w, h), (20, 20, 20, 200), radius=0.05)
+    y = HUD_H + 14
+    for s in surfs:
+        screen.blit(s, (16, y))
+        y += s.get_height()
 
 # ==========================================
 #               現代化 UI 元件
@@ -265,6 +817,7 @@ def main():
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         sock.connect((SERVER_IP, PORT))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         threading.Thread(target=recv_loop, args=(sock,), daemon=True).start()
     except: pass
 
@@ -281,9 +834,22 @@ def main():
     font_title = pygame.font.SysFont(font_name, 20, bold=True)
     # UI 字體 (中)
     font_ui = pygame.font.SysFont(font_name, 16)
+    # 等寬字體 (效能 overlay)
+    font_mono = pygame.font.SysFont("consolas,dejavusansmono,couriernew,monospace", 14)
 
+    # canvas 只是目前視窗看到的範圍，筆畫存世界座標
     canvas = pygame.Surface((WIDTH, HEIGHT - HUD_H))
     canvas.fill(CANVAS_BG)
+    view = Viewport(*canvas.get_size())
+    view_dirty = False
+    panning = False
+    # 已壓平的歷史 (伺服器 bake 後釋放幾何資料)
+    base_layer = TileLayer()
+    base_seq = 0
+    epoch = 0              # 伺服器最近一次 clear / full_state 的 epoch
+    epoch_wait = 0         # 已送出、尚未被伺服器確認的 clear / full_state 數
+    recently_deleted = {}  # stroke_id -> stroke
+    comp = LayerCompositor(canvas.get_size()) if LAYERED else None
 
     # State
     tool = "pen"
@@ -296,8 +862,14 @@ def main():
     all_strokes = []
     stroke_index = {}
     undo_stack = []
+    undo_depth = None      # 伺服器開啟壓平時限制 undo 步數
     remote_cursor = None
     last_cursor_send = 0.0
+    last_ping = 0.0
+    pending_pts = []       # 尚未送出的 stroke_point (批次)
+    pending_sid = None
+    pending_since = 0.0
+    prof = FrameProfiler()
 
     # ================= 介面佈局 (3 Zones) =================
     buttons = []
@@ -378,8 +950,17 @@ def main():
         eraser_idx = idx
         eraser_size = ERASER_SIZES[idx]
 
+    def push_undo(action):
+        undo_stack.append(action)
+        if undo_depth: del undo_stack[:-undo_depth]
+
+    def remember_deleted(st):
+        recently_deleted[st["id"]] = st
+        if len(recently_deleted) > RECENT_DELETED:
+            del recently_deleted[next(iter(recently_deleted))]
+
     def do_undo():
-        nonlocal all_strokes, stroke_index
+        nonlocal all_strokes, stroke_index, base_layer, base_seq, epoch_wait
 
         if not undo_stack:
             return
@@ -390,47 +971,163 @@ def main():
         if action["type"] == "stroke":
             sid = action["stroke_id"]
             if sid in stroke_index:
-                stroke_index.pop(sid)
+                remember_deleted(stroke_index.pop(sid))
                 all_strokes = [s for s in all_strokes if s["id"] != sid]
-                redraw_all(canvas, all_strokes)
+                stroke_removed(sid)
                 send_json(sock, {"type": "delete_stroke", "stroke_id": sid})
 
         # Undo Clear
         elif action["type"] == "clear":
             all_strokes = copy.deepcopy(action["strokes"])
             stroke_index = {s["id"]: s for s in all_strokes}
-            redraw_all(canvas, all_strokes)
-
-            # 同步給其他人
+            base_layer = action["base"]
+            base_seq = action["base_seq"]
+            recently_deleted.clear()
+            redraw()
+
+            # 同步給其他人；伺服器確認前的 bake 都是針對被取代的畫面
+            # 整個畫面塞不進一行：full_state 只帶空的底圖，筆畫和 tile 之後分批補上
+            flush_points()
+            epoch_wait += 1
             send_json(sock, {
                 "type": "full_state",
-                "strokes": all_strokes
+                "base": {"seq": base_seq, "tile": BASE_TILE, "tiles": {}},
+                "strokes": []
             })
+            for st in all_strokes: send_stroke(st)
+            send_base(None, seq=base_seq, restore=True)
+
+    def send_stroke(st):
+        """以一般的 stroke_begin / stroke_points 重送整筆 (每則不超過 BATCH_MAX_POINTS 點)"""
+        pts = st["points"]
+        msg = {"type": "stroke_begin", "stroke_id": st["id"], "owner": st["owner"], "x": pts[0][0], "y": pts[0][1],
+               "shape": st["shape"], "color": list(st["color"])}
+        if st["shape"] == "line": msg["w"] = st["w"]
+        else: msg["size"] = st["size"]
+        send_json(sock, msg)
+        for i in range(1, len(pts), BATCH_MAX_POINTS):
+            send_json(sock, {"type": "stroke_points", "stroke_id": st["id"], "pts": [list(p) for p in pts[i:i + BATCH_MAX_POINTS]]})
+
+    def send_base(keys, **fields):
+        """把底圖 tile 分批送出，最後一則帶 last=True"""
+        prev = None
+        for chunk in base_layer.encode_chunks(keys):
+            if prev is not None:
+                send_json(sock, dict(prev, type="base_layer", last=False, **fields))
+            prev = chunk
+        send_json(sock, dict(prev, type="base_layer", last=True, **fields))
 
 
     def do_clear():
+        nonlocal epoch_wait
         # 1. 記錄 undo
-        undo_stack.append({
+        push_undo({
             "type": "clear",
-            "strokes": copy.deepcopy(all_strokes)
+            "strokes": copy.deepcopy(all_strokes),
+            "base": base_layer.copy(),
+            "base_seq": base_seq
         })
 
         # 2. 本地先 clear（關鍵）
         all_strokes.clear()
         stroke_index.clear()
-        redraw_all(canvas, all_strokes)
+        base_layer.clear()
+        recently_deleted.clear()
+        redraw()
 
         # 3. 再通知 server
+        epoch_wait += 1
         send_json(sock, {"type": "clear"})
 
 
 
+    def redraw():
+        """整個畫面重畫成單一 surface；分層快取等視窗停下來再重建"""
+        with prof.span("redraw"):
+            redraw_all(canvas, all_strokes, base_layer, view)
+        if comp: comp.invalidate()
+
+    def stroke_added(st):
+        if comp: comp.append(st)
+        draw_live_point(st)
+
+    def stroke_removed(sid):
+        """all_strokes 已移除 sid 之後呼叫；分層模式只重畫受影響的層"""
+        if comp and comp.valid:
+            with prof.span("redraw_layer"):
+                comp.remove(sid)
+        elif comp:
+            with prof.span("redraw_layers"):
+                comp.rebuild(all_strokes, base_layer, view)
+        else:
+            redraw()
+
+    def draw_live_point(st):
+        """把筆畫最新的一點 / 一段畫到畫布上；在視窗外的只更新資料"""
+        pts = st["points"]
+        p = pts[-1]
+        m = stroke_margin(st)
+        if st["shape"] == "line":
+            a = pts[-2] if len(pts) >= 2 else p
+            if not view.sees((min(a[0], p[0]) - m, min(a[1], p[1]) - m, max(a[0], p[0]) + m, max(a[1], p[1]) + m)): return
+        elif not view.sees((p[0] - m, p[1] - m, p[0] + m, p[1] + m)): return
+
+        # 分層模式：畫進筆畫所在的層；不是最上層就等下一次合成 (分層失效時直接畫在畫布上)
+        targets = [canvas]
+        if comp and comp.valid:
+            surf, top = comp.target(st["id"])
+            targets = [t for t in (surf, canvas if top else None) if t is not None]
+            if not top: comp.dirty = True
+        for surf in targets:
+            if st["shape"] == "line":
+                w = max(1, int(st["w"] * view.zoom))
+                if len(pts) == 1: pygame.draw.circle(surf, st["color"], view.to_screen(p), w // 2)
+                else: draw_line_round_cap(surf, st["color"], view.to_screen(a), view.to_screen(p), w)
+            elif st["shape"] == "square":
+                draw_square_stamp(surf, view.to_screen(p), max(1, int(st["size"] * view.zoom)), st["color"])
+
+    def queue_point(sid, p):
+        """區網直接送；慢速連線累積到 batch_window (或 BATCH_MAX_POINTS 點) 後以 stroke_points 一次送"""
+        nonlocal pending_sid, pending_since
+        if pending_sid != sid: flush_points()
+        if not pending_pts:
+            if net.batch_window() <= 0:
+                send_json(sock, {"type": "stroke_point", "stroke_id": sid, "x": p[0], "y": p[1]})
+                return
+            pending_sid = sid
+            pending_since = time.perf_counter()
+        pending_pts.append([p[0], p[1]])
+        if len(pending_pts) >= BATCH_MAX_POINTS: flush_points()
+
+    def flush_points():
+        nonlocal pending_sid
+        if pending_pts:
+            if len(pending_pts) == 1:
+                x, y = pending_pts[0]
+                send_json(sock, {"type": "stroke_point", "stroke_id": pending_sid, "x": x, "y": y})
+            else:
+                send_json(sock, {"type": "stroke_points", "stroke_id": pending_sid, "pts": list(pending_pts)})
+            pending_pts.clear()
+        pending_sid = None
+
+    def draw_net_stats():
+        def ms(v): return "--" if v is None else f"{v * 1000:.1f}"
+        text = (f"RTT {ms(net.rtt)} ms   Peer {ms(net.peer_rtt)} ms   "
+                f"Up {net.tx_rate / 1024:.1f} KB/s ({net.utilization() * 100:.0f}%)   Down {net.rx_rate / 1024:.1f} KB/s   "
+                f"Cursor {net.cursor_interval() * 1000:.0f} ms   Batch {net.batch_window() * 1000:.0f} ms   "
+                f"Zoom {view.zoom * 100:.0f}%")
+        surf = font_ui.render(text, True, (220, 220, 220))
+        r = surf.get_rect(bottomright=(WIDTH - 8, HEIGHT - 6))
+        draw_rounded_rect(screen, r.inflate(12, 6), (45, 45, 48, 200), radius=0.4)
+        screen.blit(surf, r)
+
     refresh_ui()
 
     # Geometry & Event Loop (簡化版，邏輯同前)
     def get_pos(mp):
+        """螢幕座標 → 世界座標"""
         mx, my = mp
-        if my > HUD_H: return (mx, my - HUD_H)
+        if my > HUD_H: return view.to_world((mx, my - HUD_H))
         return None
 
     running = True
@@ -439,13 +1136,34 @@ def main():
     last_draw_pos = None
 
     while running:
+        prof.begin_frame(incoming.qsize())
+
+        # Networking (量測)
+        now = time.perf_counter()
+        # 收到 hello (my_id) 才算連上；離線模式不送，免得每秒印一次 Send Error
+        if my_id is not None and now - last_ping > PING_INTERVAL:
+            send_json(sock, {"type": "ping", "t": now})
+            if net.rtt is not None: send_json(sock, {"type": "net_stats", "rtt": net.rtt})
+            last_ping = now
+        if pending_pts and now - pending_since >= net.batch_window(): flush_points()
+
         # Networking (接收)
+        applied = 0
         while True:
             try: msg = incoming.get_nowait()
             except: break
+            applied += 1
             t = msg.get("type")
-            if t == "hello": my_id = int(msg["client_id"])
+            if t == "hello":
+                my_id = int(msg["client_id"])
+                undo_depth = msg.get("undo_depth")
+                epoch = msg.get("epoch", 0)
+            elif t == "epoch":
+                epoch = msg["epoch"]
+                if msg.get("ack"): epoch_wait = max(0, epoch_wait - 1)
             elif t == "cursor": remote_cursor = (int(msg["x"]), int(msg["y"]))
+            elif t == "net_stats":
+                if isinstance(msg.get("rtt"), (int, float)): net.peer_rtt = float(msg["rtt"])
             elif t == "stroke_begin":
                 sid = msg["stroke_id"]
                 s_shape = msg.get("shape", "line")
@@ -458,41 +1176,88 @@ def main():
                 else: st["size"] = int(msg["size"])
                 stroke_index[sid] = st
                 all_strokes.append(st)
-                if s_shape == "square": draw_square_stamp(canvas, st["points"][0], st["size"], st["color"])
+                stroke_added(st)
             
             elif t == "stroke_point":
                 sid = msg["stroke_id"]
                 st = stroke_index.get(sid)
                 if st:
-                    p = (int(msg["x"]), int(msg["y"]))
-                    st["points"].append(p)
-                    if st["shape"] == "line" and len(st["points"]) >= 2:
-                        draw_line_round_cap(canvas, st["color"], st["points"][-2], st["points"][-1], st["w"])
-                    elif st["shape"] == "square":
-                        draw_square_stamp(canvas, p, st["size"], st["color"])
+                    add_point(st, (int(msg["x"]), int(msg["y"])))
+                    draw_live_point(st)
+
+            elif t == "stroke_points":
+                sid = msg["stroke_id"]
+                st = stroke_index.get(sid)
+                if st:
+                    for x, y in msg["pts"]:
+                        add_point(st, (int(x), int(y)))
+                        draw_live_point(st)
 
             elif t == "delete_stroke":
                 sid = msg["stroke_id"]
                 if sid in stroke_index:
                     stroke_index.pop(sid)
                     all_strokes = [s for s in all_strokes if s["id"] != sid]
-                    redraw_all(canvas, all_strokes)
+                    stroke_removed(sid)
 
             elif t == "full_state":
                 all_strokes = []
                 stroke_index = {}
+                recently_deleted.clear()
+
+                base = msg.get("base")
+                if base:
+                    base_layer.load(base)
+                    base_seq = base["seq"]
+                else:
+                    base_layer.clear()
+                for st in msg.get("baked", []):
+                    base_layer.draw_stroke(st)
 
                 for st in msg["strokes"]:
                     stroke_index[st["id"]] = st
                     all_strokes.append(st)
 
-                redraw_all(canvas, all_strokes)
+                redraw()
 
             elif t == "clear":
                 all_strokes.clear()
                 stroke_index.clear()
-                redraw_all(canvas, all_strokes)
-
+                base_layer.clear()
+                recently_deleted.clear()
+                redraw()
+
+            # 伺服器確認這些筆畫已超出 undo 範圍：壓進底圖並釋放
+            # 自己的 clear / undo clear 還沒被確認、或是舊 epoch 的 bake：畫面已被取代，忽略
+            elif t == "bake" and not epoch_wait and msg.get("epoch", 0) >= epoch:
+                ids = set(msg["stroke_ids"])
+                touched = set()
+                revived = False
+                # 依伺服器的順序畫 (z-order)；本地剛刪掉、但伺服器先壓平的筆畫也要畫，和其他人一致
+                for sid in msg["stroke_ids"]:
+                    st = stroke_index.pop(sid, None)
+                    if st is None:
+                        st = recently_deleted.pop(sid, None)
+                        revived = revived or st is not None
+                    if st:
+                        touched.update(base_layer.draw_stroke(st))
+                all_strokes = [s for s in all_strokes if s["id"] not in ids]
+                undo_stack[:] = [a for a in undo_stack if a["type"] != "stroke" or a["stroke_id"] not in ids]
+                base_seq = msg["seq"]
+                # 畫面不變 (除非有刪除被 bake 蓋掉)，但分層快取裡還留著這些筆畫，要依新的底圖重新分層
+                if revived: redraw()
+                elif comp: comp.invalidate()
+                if msg.get("upload"):
+                    # full: 伺服器還缺更早的底圖，整張重傳；否則只傳這次碰到的 tile
+                    send_base(None if msg.get("full") else touched, seq=base_seq, full=bool(msg.get("full")))
+
+            # 對方 undo clear 後分批補上的底圖
+            elif t == "base_layer" and msg.get("restore"):
+                base_layer.merge(msg)
+                redraw()
+
+        prof.count_applied(applied)
+        prof.lap("net")
 
         # Input
         mx, my = pygame.mouse.get_pos()
@@ -502,7 +1267,15 @@ def main():
             slider_brush.handle_event(event)
             slider_eraser.handle_event(event)
 
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button in (2, 3) and my > HUD_H:
+                panning = True
+
+            elif event.type == pygame.MOUSEWHEEL:
+                if my > HUD_H:
+                    view.zoom_at((mx, my - HUD_H), ZOOM_STEP ** event.y)
+                    view_dirty = True
+
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                 if my < HUD_H:
                     for b in buttons:
                         if b.hit((mx, my)):
@@ -516,44 +1289,49 @@ def main():
                         # Item Eraser Logic
                         if tool == "item_eraser":
                             r = pygame.Rect(cpos[0]-eraser_size//2, cpos[1]-eraser_size//2, eraser_size, eraser_size)
-                            for s in list(all_strokes)[::-1]:
-                                if s["owner"] == my_id:
-                                    hit = False
-                                    if s["shape"]=="square" and any(r.collidepoint(p) for p in s["points"]): hit = True
-                                    elif s["shape"]=="line":
-                                        for i in range(1, len(s["points"])):
-                                            if segment_intersects_rect(*s["points"][i-1], *s["points"][i], r):
-                                                hit = True; break
-                                    if hit:
-                                        send_json(sock, {"type": "delete_stroke", "stroke_id": s["id"]})
-                                        # Local delete
-                                        stroke_index.pop(s["id"])
-                                        all_strokes.remove(s)
-                                        redraw_all(canvas, all_strokes)
-                                        break
+                            with prof.span("eraser_scan"):
+                                for s in list(all_strokes)[::-1]:
+                                    if s["owner"] == my_id:
+                                        bb = stroke_bbox(s)
+                                        if not r.colliderect((bb[0], bb[1], bb[2] - bb[0], bb[3] - bb[1])): continue
+                                        hit = False
+                                        if s["shape"]=="square" and any(r.collidepoint(p) for p in s["points"]): hit = True
+                                        elif s["shape"]=="line":
+                                            for i in range(1, len(s["points"])):
+                                                if segment_intersects_rect(*s["points"][i-1], *s["points"][i], r):
+                                                    hit = True; break
+                                        if hit:
+                                            send_json(sock, {"type": "delete_stroke", "stroke_id": s["id"]})
+                                            # Local delete
+                                            remember_deleted(stroke_index.pop(s["id"]))
+                                            all_strokes.remove(s)
+                                            stroke_removed(s["id"])
+                                            break
                         else:
                             # Start drawing
+                            flush_points()
                             curr_sid = f"{my_id}-{int(time.time()*1000)}"
                             msg = {"type": "stroke_begin", "stroke_id": curr_sid, "owner": my_id, "x": cpos[0], "y": cpos[1]}
                             
                             if tool == "pen":
                                 st = {"id": curr_sid, "owner": my_id, "shape": "line", "color": brush_color, "w": brush_w, "points": [cpos]}
                                 msg.update({"shape": "line", "color": list(brush_color), "w": brush_w})
-                                pygame.draw.circle(canvas, brush_color, cpos, brush_w//2)
                             else:
                                 st = {"id": curr_sid, "owner": my_id, "shape": "square", "color": CANVAS_BG, "size": eraser_size, "points": [cpos]}
                                 msg.update({"shape": "square", "color": list(CANVAS_BG), "size": eraser_size})
-                                draw_square_stamp(canvas, cpos, eraser_size, CANVAS_BG)
                             
                             stroke_index[curr_sid] = st
                             all_strokes.append(st)
-                            undo_stack.append({
+                            stroke_added(st)
+                            push_undo({
                                 "type": "stroke",
                                 "stroke_id": curr_sid
                             })
                             send_json(sock, msg)
 
             elif event.type == pygame.MOUSEBUTTONUP:
+                if event.button in (2, 3): panning = False
+                flush_points()
                 drawing = False
                 curr_sid = None
 
@@ -561,19 +1339,22 @@ def main():
                 # Hover effect check
                 for b in buttons: b.check_hover((mx, my))
 
+                if panning:
+                    view.pan(*event.rel)
+                    view_dirty = True
+
                 cpos = get_pos((mx, my))
                 if cpos and my_id:
-                    if time.time() - last_cursor_send > 0.05:
+                    if time.time() - last_cursor_send > net.cursor_interval():
                         send_json(sock, {"type": "cursor", "x": cpos[0], "y": cpos[1]})
                         last_cursor_send = time.time()
                 
                 if drawing and cpos and curr_sid:
                     st = stroke_index.get(curr_sid)
                     if st:
-                        st["points"].append(cpos)
                         if tool == "pen":
-                            if len(st["points"]) >= 2:
-                                draw_line_round_cap(canvas, st["color"], st["points"][-2], st["points"][-1], st["w"])
+                            add_point(st, cpos)
+                            draw_live_point(st)
                         elif tool == "pixel_eraser":
                             # Simple interpolation
                             dist = math.hypot(cpos[0]-last_draw_pos[0], cpos[1]-last_draw_pos[1])
@@ -583,15 +1364,35 @@ def main():
                                 t = i/n
                                 px = int(last_draw_pos[0] + (cpos[0]-last_draw_pos[0])*t)
                                 py = int(last_draw_pos[1] + (cpos[1]-last_draw_pos[1])*t)
-                                draw_square_stamp(canvas, (px, py), eraser_size, CANVAS_BG)
-                                send_json(sock, {"type": "stroke_point", "stroke_id": curr_sid, "x": px, "y": py})
+                                add_point(st, (px, py))
+                                draw_live_point(st)
+                                queue_point(curr_sid, (px, py))
                             last_draw_pos = cpos
                         
                         if tool == "pen":
-                            send_json(sock, {"type": "stroke_point", "stroke_id": curr_sid, "x": cpos[0], "y": cpos[1]})
+                            queue_point(curr_sid, cpos)
 
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_z: do_undo()
+                elif event.key == pygame.K_HOME:
+                    view.reset()
+                    view_dirty = True
+                elif event.key == pygame.K_F3: prof.toggle()
+                elif event.key == pygame.K_F4:
+                    path = time.strftime("trace-%Y%m%d-%H%M%S.json")
+                    if prof.export_chrome_trace(path): print(f"Trace saved: {path}")
+
+        if view_dirty:
+            redraw()
+            view_dirty = False
+        elif comp and not comp.valid and not panning and time.monotonic() - comp.invalid_since > LAYER_REBUILD_DELAY:
+            with prof.span("redraw_layers"):
+                comp.rebuild(all_strokes, base_layer, view)
+        elif comp and comp.valid and comp.stale_since is not None:
+            with prof.span("redraw_layer"):
+                comp.refresh()
+
+        prof.lap("input")
 
         # Render
         screen.fill(WINDOW_BG)
@@ -605,8 +1406,12 @@ def main():
         for b in buttons: b.draw(screen, font_ui)
         slider_brush.draw(screen)
         slider_eraser.draw(screen)
+        prof.lap("hud")
 
         # Canvas
+        if comp and comp.dirty:
+            with prof.span("composite"):
+                comp.composite(canvas)
         screen.blit(canvas, (0, HUD_H))
 
         # Cursors
@@ -616,18 +1421,28 @@ def main():
             cpos = (mx, my - HUD_H)
             p_y = my
             if tool == "pen":
-                pygame.draw.circle(screen, brush_color, (mx, my), brush_w//2, 1)
-                pygame.draw.circle(screen, (200, 200, 200), (mx, my), brush_w//2+1, 1)
+                r = max(1, int(brush_w * view.zoom)) // 2
+                pygame.draw.circle(screen, brush_color, (mx, my), r, 1)
+                pygame.draw.circle(screen, (200, 200, 200), (mx, my), r+1, 1)
             else:
-                s = eraser_size
+                s = max(1, int(eraser_size * view.zoom))
                 pygame.draw.rect(screen, (0,0,0), (mx-s//2, my-s//2, s, s), 1)
 
         if remote_cursor:
-            rx, ry = remote_cursor
-            pygame.draw.circle(screen, (0, 255, 0), (rx, ry+HUD_H), 5)
+            rx, ry = view.to_screen(remote_cursor)
+            if 0 <= ry < view.h: pygame.draw.circle(screen, (0, 255, 0), (rx, ry+HUD_H), 5)
+
+        prof.lap("canvas")
+
+        draw_net_stats()
+        if prof.enabled: draw_profiler_overlay(screen, prof, font_mono)
+        prof.lap("overlay")
 
         pygame.display.flip()
+        prof.lap("flip")
         clock.tick(120)
+        prof.lap("idle")
+        prof.end_frame()
 
     pygame.quit()
 
@@ -0,0 +1,55 @@
+import re
+
+# 以換行分隔的 JSON 串流：client / server 共用的拆包工具
+
+
+class LineFramer:
+    """
+    換行分隔串流的拆包器
+    bytearray + 掃描位移：每個位元組只搜尋一次，每次 feed 只搬移一次剩餘資料，
+    所以就算單行有好幾 MB 也是線性時間 (原本 buf += / split 每行都會整段複製)
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.scan = 0   # buf[:scan] 已確認沒有換行
+
+    def feed(self, data):
+        """加入新收到的資料，回傳完整的行 (bytes，含結尾換行)"""
+        buf = self.buf
+        buf += data
+        lines = []
+        start = 0
+        while True:
+            i = buf.find(b"\n", self.scan)
+            if i < 0:
+                break
+            lines.append(bytes(buf[start:i + 1]))
+            start = self.scan = i + 1
+        if start:
+            del buf[:start]
+        self.scan = len(buf)
+        return lines
+
+    def pending(self):
+        """尚未收到換行的位元組數"""
+        return len(self.buf)
+
+
+# client 一律用 json.dumps(separators=(",", ":")) 送出，且 "type" 是第一個 key
+_TYPE_RE = re.compile(rb'\{"type":"(\w+)"')
+_POINT_RE = re.compile(rb'\{"type":"stroke_point","stroke_id":"([^"\\]*)","x":(-?\d+),"y":(-?\d+)\}\s*$')
+
+
+def peek_type(line):
+    """只看開頭取出訊息類型；格式不符回傳 None (呼叫端改用完整 json 解析)"""
+    m = _TYPE_RE.match(line)
+    return m.group(1).decode() if m else None
+
+
+def parse_stroke_point(line):
+    """stroke_point 的快速解析；格式不符回傳 None"""
+    m = _POINT_RE.match(line)
+    if not m:
+        return None
+    return {"type": "stroke_point", "stroke_id": m.group(1).decode(),
+            "x": int(m.group(2)), "y": int(m.group(3))}
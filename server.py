@@ -1,15 +1,86 @@
 import socket
 import threading
 import json
+import time
+from framing import LineFramer, peek_type, parse_stroke_point
+from tiles import BASE_TILE, stroke_tiles
 
 # 所有網卡(local host、Wi-Fi IP、有線網路IP)
 HOST = "0.0.0.0"
 PORT = 5001
 
+# 每個 client 的流量限制 (token bucket)
+MSG_RATE = 500                       # 每秒可處理訊息數
+MSG_BURST = 1000
+BYTE_RATE = 1024 * 1024              # 每秒可接收位元組
+BYTE_BURST = 4 * 1024 * 1024
+
+# 單則訊息 / 房間大小上限
+MAX_LINE_BYTES = 4 * 1024 * 1024     # 單行上限 (client 分批送的底圖每則約 512KB)
+MAX_MSG_BYTES = 16 * 1024            # LARGE_MESSAGES 以外的訊息上限
+MAX_POINTS_PER_STROKE = 20000
+MAX_STROKES = 5000
+MAX_VIOLATIONS = 20                  # 格式錯誤訊息累計上限
+MAX_BASE_TILES = 4096                # 底圖 tile 數上限 (undo clear 還原的底圖)
+
+# 伺服器不需要狀態的訊息：只驗證 JSON 格式，原封不動轉發
+RELAY_ONLY = {"cursor", "net_stats"}
+# 可超過 MAX_MSG_BYTES 的訊息 (受 MAX_LINE_BYTES 限制)
+# (full_state 只帶底圖的 header，筆畫另外以 stroke_begin / stroke_points 送)
+LARGE_MESSAGES = {"base_layer"}
+
+# 歷史壓平：超出 undo 範圍的筆畫烤進 client 的底圖，伺服器釋放幾何資料
+FLATTEN = True
+UNDO_DEPTH = 32        # 每位 client 可 undo 的步數 (hello 時告知 client)
+FLATTEN_BATCH = 32     # 累積多少可壓平的筆畫才壓一次
+FLATTEN_MAX_LIVE = 4 * UNDO_DEPTH   # 最新幾筆以外的筆畫一律可壓 (閒置 client 的筆畫不會永遠擋住壓平)
+
 all_strokes = {}  
 # stroke_id -> stroke dict
 # 存畫面狀態
 
+base_layer = None   # client 上傳的底圖 {"seq", "tile", "tiles": {"tx,ty": tile}}
+bake_seq = 0
+epoch_seq = 0       # 最近一次 clear / full_state 時的 bake_seq；更早的 bake 與底圖上傳都作廢
+baked_pending = []  # [(seq, [stroke, ...])] 已壓平、但底圖還沒上傳的筆畫
+bake_uploader = {}  # seq -> 負責上傳該次底圖的 conn (只接受它的上傳)
+restoring = None    # 正在分批補上 undo clear 底圖的 conn；補完之前不壓平
+stroke_session = {}  # stroke_id -> 畫出該筆畫的連線 session (斷線重連後 undo_stack 是空的)
+session_seq = 0
+
+class ClientViolation(Exception):
+    """client 違反限制，需要斷線"""
+
+
+class TokenBucket:
+    """
+    Token bucket，允許透支
+    take() 回傳需等待的秒數 (0 表示不需限速)
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self, n=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+def throttle(bucket, n):
+    """
+    扣 token；不足時暫停讀取 socket 直到還清，讓 TCP 回壓把 client 壓在額度內
+    (超速的 client 只會被限速，不會斷線)
+    """
+    wait = bucket.take(n)
+    if wait > 0:
+        time.sleep(wait)
+
 def get_local_wifi_ip():
     """
     取得本機在 Wi-Fi / LAN 上的 IP
@@ -24,8 +95,11 @@ def get_local_wifi_ip():
         return "127.0.0.1"
 
 
-lock = threading.Lock()
-clients = {}  # conn -> {"id": 1/2, "addr": (ip,port)}
+# 房間狀態 (筆畫、底圖、bake/epoch 序號…) 的修改與對各 conn 的傳送都在這把鎖內，
+# 各 client 的執行緒才不會交錯改狀態、或把兩行訊息的位元組混在一起
+# 可重入：handle_message 持鎖時會再呼叫 broadcast / maybe_bake
+lock = threading.RLock()
+clients = {}  # conn -> {"id": 1/2, "addr": (ip,port), "session": 連線序號, "upload": 收到一半的底圖}
 
 def send_json(conn: socket.socket, obj: dict):
     data = (json.dumps(obj, separators=(",", ":")) + "\n").encode("utf-8")
@@ -41,6 +115,10 @@ def safe_send(conn, obj):
 # 收到的內容轉播給另個
 def broadcast(except_conn, obj):
     data = (json.dumps(obj, separators=(",", ":")) + "\n").encode("utf-8")
+    broadcast_raw(except_conn, data)
+
+# 直接轉發收到的原始位元組 (含換行)，不重新 json.dumps
+def broadcast_raw(except_conn, data):
     with lock:
         for c in list(clients.keys()):
             if c is except_conn:
@@ -63,14 +141,75 @@ def update_partner_status():
             safe_send(conn, {"type": "status", "state": "paired" if partner_online else "waiting",
                              "partner_online": partner_online})
 
+def maybe_bake():
+    """
+    從最舊的筆畫開始，找出已無法 undo 的連續前綴 (只壓前綴才能保持 z-order)，
+    數量夠多就通知所有 client 壓進底圖
+    無法 undo：畫出它的連線已斷 (重連的 client 拿不回 undo_stack)、
+    該連線之後又畫了 UNDO_DEPTH 筆，或已不在最新的 FLATTEN_MAX_LIVE 筆之內
+    """
+    global bake_seq
+    if not FLATTEN or restoring is not None:
+        return
+    strokes = list(all_strokes.values())
+    with lock:
+        live = {info["session"] for info in clients.values()}
+    remaining = {}
+    for st in strokes:
+        s = stroke_session.get(st["id"])
+        if s in live:
+            remaining[s] = remaining.get(s, 0) + 1
+    forced = len(strokes) - FLATTEN_MAX_LIVE
+    prefix = []
+    for i, st in enumerate(strokes):
+        s = stroke_session.get(st["id"])
+        if s in live:
+            remaining[s] -= 1
+            if remaining[s] < UNDO_DEPTH and i >= forced:
+                break
+        prefix.append(st)
+    if len(prefix) < FLATTEN_BATCH:
+        return
+
+    for st in prefix:
+        all_strokes.pop(st["id"], None)
+        stroke_session.pop(st["id"], None)
+    bake_seq += 1
+    # 之前還有底圖沒收到 (上傳者斷線或還在傳)：這次要求整張重傳
+    full = bool(baked_pending)
+    baked_pending.append((bake_seq, prefix))
+    msg = {"type": "bake", "seq": bake_seq, "epoch": epoch_seq,
+           "stroke_ids": [st["id"] for st in prefix], "full": full}
+    with lock:
+        # 由 id 最小的 client 負責上傳壓好的底圖
+        uploader = min(clients.items(), key=lambda kv: kv[1]["id"])[0] if clients else None
+        bake_uploader[bake_seq] = uploader
+        for c in list(clients.keys()):
+            safe_send(c, dict(msg, upload=c is uploader))
+
+def send_epoch(sender):
+    """
+    clear / full_state 後通知所有 client 新的 epoch
+    發送者收到 ack 前會忽略 bake (那些 bake 可能是針對被取代的畫面)
+    """
+    with lock:
+        for c in list(clients.keys()):
+            safe_send(c, {"type": "epoch", "epoch": epoch_seq, "ack": c is sender})
+
 # 新增，用來處理畫畫可以存
+# 回傳 False 表示訊息被丟棄，不轉發
 def handle_message(conn, msg):
-    global all_strokes
+    global all_strokes, base_layer, epoch_seq, restoring
 
     t = msg.get("type")
 
     if t == "stroke_begin":
         sid = msg["stroke_id"]
+        if len(all_strokes) >= MAX_STROKES:
+            # 房間已滿：請發送者把自己本地的筆畫撤掉，保持雙方一致
+            with lock:
+                safe_send(conn, {"type": "delete_stroke", "stroke_id": sid})
+            return False
         all_strokes[sid] = {
             "id": sid,
             "owner": msg["owner"],
@@ -80,48 +219,194 @@ def handle_message(conn, msg):
             "size": msg.get("size"),
             "points": [(msg["x"], msg["y"])]
         }
+        # 歸給目前 id 等於 owner 的連線 (undo clear 重送的筆畫可能是對方的)
+        stroke_session[sid] = next((info["session"] for info in clients.values() if info["id"] == msg["owner"]), None)
+        maybe_bake()
 
     elif t == "stroke_point":
-        sid = msg["stroke_id"]
-        if sid in all_strokes:
-            all_strokes[sid]["points"].append((msg["x"], msg["y"]))
+        st = all_strokes.get(msg["stroke_id"])
+        if st is None or len(st["points"]) >= MAX_POINTS_PER_STROKE:
+            return False
+        st["points"].append((msg["x"], msg["y"]))
+
+    # 慢速連線時 client 會把多個點合併成一則
+    elif t == "stroke_points":
+        st = all_strokes.get(msg["stroke_id"])
+        pts = msg["pts"]
+        if st is None or len(st["points"]) + len(pts) > MAX_POINTS_PER_STROKE:
+            return False
+        st["points"].extend((x, y) for x, y in pts)
 
     elif t == "delete_stroke":
         sid = msg["stroke_id"]
-        all_strokes.pop(sid, None)
+        # 已被壓平 (與 bake 交錯)：雙方都照 bake 把它畫進底圖，不轉發
+        if all_strokes.pop(sid, None) is None:
+            return False
+        stroke_session.pop(sid, None)
 
     elif t == "clear":
         all_strokes.clear()
+        stroke_session.clear()
+        base_layer = None
+        baked_pending.clear()
+        bake_uploader.clear()
+        restoring = None
+        epoch_seq = bake_seq
+        send_epoch(conn)
+
+    # Undo Clear：client 先送底圖的 header，筆畫之後以 stroke_begin / stroke_points、
+    # 底圖的 tile 以 restore 的 base_layer 分批送來
+    elif t == "full_state":
+        strokes = msg["strokes"]
+        if len(strokes) > MAX_STROKES or any(len(st["points"]) > MAX_POINTS_PER_STROKE for st in strokes):
+            send_epoch(conn)
+            return False
+        all_strokes = {st["id"]: st for st in strokes}
+        # 還原的筆畫歸給目前同 id 的連線 (其他的已無人能 undo)
+        with lock:
+            sessions = {info["id"]: info["session"] for info in clients.values()}
+        stroke_session.clear()
+        stroke_session.update((st["id"], sessions.get(st["owner"])) for st in strokes)
+        base = msg.get("base")
+        base_layer = dict(base, tiles=dict(base["tiles"])) if base else None
+        restoring = conn if base else None
+        baked_pending.clear()
+        bake_uploader.clear()
+        epoch_seq = bake_seq
+        send_epoch(conn)
+
+    elif t == "base_layer":
+        last = msg.get("last", True)
+        # undo clear 的底圖：併入並轉發給其他 client
+        if msg.get("restore"):
+            if restoring is not conn or base_layer is None:
+                return False
+            if len(base_layer["tiles"].keys() | msg["tiles"].keys()) > MAX_BASE_TILES:
+                raise ClientViolation("base layer too large")
+            base_layer["tiles"].update(msg["tiles"])
+            if last:
+                restoring = None
+            return True
+
+        # 負責上傳的 client 送來壓好的底圖 tile (full 為整張，否則只有變動的 tile)，
+        # 可能分成多則，收到 last 才生效；只存不轉發
+        seq = msg["seq"]
+        info = clients[conn]
+        # 只接受指定的上傳者、且是這個 epoch 內發出的 bake
+        # (上傳中途有人 clear / undo clear：這份底圖已作廢)
+        if not epoch_seq < seq <= bake_seq or bake_uploader.get(seq) is not conn:
+            info.pop("upload", None)
+            return False
+        upload = info.get("upload")
+        if upload is None or upload["seq"] != seq:
+            # 只收這次 bake 的筆畫碰到的 tile (full：再加上目前底圖已有的)，暫存大小因此有上限
+            allowed = {f"{tx},{ty}" for s, strokes in baked_pending if s == seq or (msg.get("full") and s < seq)
+                       for st in strokes for tx, ty in stroke_tiles(st)}
+            if msg.get("full") and base_layer is not None:
+                allowed |= base_layer["tiles"].keys()
+            upload = info["upload"] = {"seq": seq, "tiles": {}, "allowed": allowed}
+        if not upload["allowed"].issuperset(msg["tiles"]):
+            del info["upload"]
+            raise ValueError("unexpected tile")
+        upload["tiles"].update(msg["tiles"])
+        if not last:
+            return False
+        del info["upload"]
+        if base_layer is None or seq > base_layer["seq"]:
+            if base_layer is None or msg.get("full"):
+                base_layer = {"seq": seq, "tile": BASE_TILE, "tiles": upload["tiles"]}
+            else:
+                base_layer["seq"] = seq
+                base_layer["tiles"].update(upload["tiles"])
+            baked_pending[:] = [(s, b) for s, b in baked_pending if s > seq]
+            for s in [s for s in bake_uploader if s <= seq]: del bake_uploader[s]
+        return False
+
+    # 未知或只有伺服器會送的訊息 (hello、bake、epoch…)：不轉發
+    else:
+        return False
+
+    return True
 
 
 def handle_client(conn: socket.socket, addr):
+    global restoring
+    msg_bucket = TokenBucket(MSG_RATE, MSG_BURST)
+    byte_bucket = TokenBucket(BYTE_RATE, BYTE_BURST)
+    violations = 0
     try:
-        buf = b""
+        framer = LineFramer()
         while True:
-            data = conn.recv(4096)
+            data = conn.recv(65536)
             if not data:
                 break
-            buf += data
-            while b"\n" in buf:
-                raw, buf = buf.split(b"\n", 1)
-                line = raw.decode("utf-8", errors="ignore").strip()
-                if not line:
+            throttle(byte_bucket, len(data))
+            for raw in framer.feed(data):
+                if len(raw) > MAX_LINE_BYTES:
+                    raise ClientViolation("line too long")
+                if raw.isspace():
                     continue
-                # 任何 client 的事件都轉發給另一位
-                msg = json.loads(line)
-                handle_message(conn, msg)
-                broadcast(conn, msg)
+                throttle(msg_bucket, 1)
+                try:
+                    msg = None
+                    t = peek_type(raw)
+                    if t is None:
+                        msg = json.loads(raw)
+                        t = msg.get("type")
+                    if len(raw) > MAX_MSG_BYTES and t not in LARGE_MESSAGES:
+                        raise ClientViolation("message too large")
+                    # RTT 量測：原封不動回給發送者，不轉發
+                    if t == "ping":
+                        if msg is None:
+                            msg = json.loads(raw)
+                        with lock:
+                            safe_send(conn, {"type": "pong", "t": msg.get("t")})
+                        continue
+                    if t in RELAY_ONLY:
+                        # 不處理內容，但壞掉的 JSON 不轉發且計入違規
+                        if msg is None and not isinstance(json.loads(raw), dict):
+                            raise TypeError("message is not an object")
+                        broadcast_raw(conn, raw)
+                        continue
+                    if msg is None and t == "stroke_point":
+                        msg = parse_stroke_point(raw)
+                    if msg is None:
+                        msg = json.loads(raw)
+                    # 任何 client 的事件都轉發給另一位 (原始位元組)；
+                    # 在同一把鎖內，其他執行緒的 bake / epoch 不會插在狀態改變與轉發之間
+                    with lock:
+                        if handle_message(conn, msg):
+                            broadcast_raw(conn, raw)
+                except ClientViolation:
+                    raise
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    violations += 1
+                    if violations > MAX_VIOLATIONS:
+                        raise ClientViolation("too many malformed messages")
+            if framer.pending() > MAX_LINE_BYTES:
+                raise ClientViolation("line too long")
+    except ClientViolation as e:
+        print(f"[!] Kick {addr}: {e}")
+        with lock:
+            safe_send(conn, {"type": "error", "msg": str(e)})
     except:
         pass
     finally:
         with lock:
             info = clients.pop(conn, None)
-        try:
-            conn.close()
-        except:
-            pass
-        print(f"[-] Disconnected {addr} (id={info['id'] if info else None})")
-        update_partner_status()
+            # 底圖補到一半就斷線：只能用已收到的部分
+            if restoring is conn:
+                restoring = None
+            for seq in [seq for seq, c in bake_uploader.items() if c is conn]:
+                del bake_uploader[seq]
+            try:
+                conn.close()
+            except:
+                pass
+            print(f"[-] Disconnected {addr} (id={info['id'] if info else None})")
+            update_partner_status()
+            # 斷線者的筆畫已無法 undo
+            maybe_bake()
 
 def main():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -150,6 +435,9 @@ def main():
             # 產生專用通道conn
             # 一個client對應一個socket
             conn, addr = s.accept()
+            # 小封包即時送出 (批次由 client 依 RTT 自行決定)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            global session_seq
             with lock:
                 if len(clients) >= 2:
                     safe_send(conn, {"type": "error", "msg": "Server full (max 2)"})
@@ -158,16 +446,22 @@ def main():
                     continue
 
                 assigned = 1 if 1 not in [v["id"] for v in clients.values()] else 2
-                clients[conn] = {"id": assigned, "addr": addr}
-
-            print(f"[+] Connected {addr}, assigned id={assigned}")
-            safe_send(conn, {"type": "hello", "client_id": assigned})
-            # 把目前畫面狀態送給新 client
-            safe_send(conn, {
-                "type": "full_state",
-                "strokes": list(all_strokes.values())
-            })
-            update_partner_status()
+                session_seq += 1
+                clients[conn] = {"id": assigned, "addr": addr, "session": session_seq}
+
+                print(f"[+] Connected {addr}, assigned id={assigned}")
+                # 持鎖送完：其他執行緒的轉發 / bake 只會排在完整的畫面狀態之後
+                safe_send(conn, {"type": "hello", "client_id": assigned,
+                                 "undo_depth": UNDO_DEPTH if FLATTEN else None, "epoch": epoch_seq})
+                # 把目前畫面狀態送給新 client
+                # base: 底圖；baked: 已壓平但尚未併入底圖的筆畫 (client 直接畫進底圖)
+                safe_send(conn, {
+                    "type": "full_state",
+                    "base": base_layer,
+                    "baked": [st for _, strokes in baked_pending for st in strokes],
+                    "strokes": list(all_strokes.values())
+                })
+                update_partner_status()
 
             threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
 
@@ -0,0 +1,37 @@
+# 壓平底圖的 tile 切分：client (畫進底圖) / server (檢查上傳的 tile) 共用
+
+BASE_TILE = 512            # 底圖 tile 大小 (世界座標)
+
+
+def stroke_margin(st):
+    """筆寬 / 橡皮擦大小的一半 (外框需要往外擴)"""
+    size = st.get("w") if st["shape"] == "line" else st.get("size")
+    return (size or 0) // 2 + 1
+
+def stroke_segments(st):
+    """筆畫依序拆成線段 (a, b)；單點的線與方形印章是 (p, p)"""
+    pts = st["points"]
+    if st["shape"] == "line" and len(pts) >= 2:
+        return zip(pts, pts[1:])
+    return ((p, p) for p in pts)
+
+def segment_tiles(a, b, m):
+    """粗細為 2*m 的線段 a-b 經過的 tile (逐欄算出線段在該欄的 y 範圍)"""
+    (ax, ay), (bx, by) = sorted((tuple(a), tuple(b)))
+    keys = []
+    for tx in range(int((ax - m) // BASE_TILE), int((bx + m) // BASE_TILE) + 1):
+        x0 = min(max(tx * BASE_TILE - m, ax), bx)
+        x1 = min(max((tx + 1) * BASE_TILE + m, ax), bx)
+        if bx == ax:
+            y0, y1 = ay, by
+        else:
+            y0 = ay + (by - ay) * (x0 - ax) / (bx - ax)
+            y1 = ay + (by - ay) * (x1 - ax) / (bx - ax)
+        for ty in range(int((min(y0, y1) - m) // BASE_TILE), int((max(y0, y1) + m) // BASE_TILE) + 1):
+            keys.append((tx, ty))
+    return keys
+
+def stroke_tiles(st):
+    """筆畫碰到的所有 tile key"""
+    m = stroke_margin(st)
+    return {key for a, b in stroke_segments(st) for key in segment_tiles(a, b, m)}